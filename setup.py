@@ -53,4 +53,9 @@ setup(
     extras_require={
         'test': read('requirements-test.txt', as_list=True)
     },
+    entry_points={
+        'console_scripts': [
+            'watson-mail = watson.mail.cli:main',
+        ],
+    },
 )
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import smtplib
+from watson.mail import backends, Message
+from watson.mail.backends.concurrency import AIMD, is_temporary_failure
+from watson.mail.backends.smtp import SMTPMaxRetryError
+from tests.watson.mail.support import LocalSMTPServer
+
+
+def _retry_error(cause):
+    try:
+        raise SMTPMaxRetryError('Reached maximum retries') from cause
+    except SMTPMaxRetryError as exc:
+        return exc
+
+
+class TestIsTemporaryFailure(object):
+    def test_temporary(self):
+        assert is_temporary_failure(
+            smtplib.SMTPSenderRefused(451, b'Busy', 'a@test.com'))
+        assert is_temporary_failure(smtplib.SMTPServerDisconnected())
+        assert is_temporary_failure(ConnectionRefusedError())
+        assert is_temporary_failure(_retry_error(
+            smtplib.SMTPConnectError(421, b'Too many connections')))
+        assert is_temporary_failure(smtplib.SMTPRecipientsRefused(
+            {'a@test.com': (450, b'Try later')}))
+
+    def test_permanent(self):
+        assert not is_temporary_failure(ValueError())
+        assert not is_temporary_failure(_retry_error(
+            smtplib.SMTPDataError(554, b'Rejected')))
+        assert not is_temporary_failure(smtplib.SMTPRecipientsRefused(
+            {'a@test.com': (450, b'Try later'), 'b@test.com': (550, b'')}))
+
+
+class TestAIMD(object):
+    def test_additive_increase(self):
+        controller = AIMD(initial=2, maximum=3, latency_tolerance=None)
+        controller.record(0.1)
+        assert controller.limit == 2
+        controller.record(0.1)
+        assert controller.limit == 3
+        assert controller.batch_size == 11
+        for i in range(6):
+            controller.record(0.1)
+        assert controller.limit == 3
+        assert [decision['reason'] for decision in controller.decisions] == [
+            'increase', 'increase', 'increase']
+
+    def test_multiplicative_decrease(self):
+        controller = AIMD(initial=8, batch_size=20)
+        controller.record(0.1, temporary_failure=True)
+        assert controller.limit == 4
+        assert controller.batch_size == 10
+        # further failures within the same window are the same congestion
+        for i in range(3):
+            controller.record(0.1, temporary_failure=True)
+        assert controller.limit == 4
+        controller.record(0.1, temporary_failure=True)
+        assert controller.limit == 2
+        metrics = controller.metrics
+        assert metrics['temporary_failures'] == 5
+        assert metrics['decisions'][-1]['reason'] == 'temporary failure'
+
+    def test_minimum(self):
+        controller = AIMD(initial=1, minimum=1)
+        controller.record(0.1, temporary_failure=True)
+        assert controller.limit == 1
+        assert controller.batch_size == 5
+
+    def test_latency(self):
+        controller = AIMD(initial=4, latency_tolerance=2)
+        controller.record(0.1)
+        controller.record(0.15)
+        assert controller.limit == 4
+        controller.record(0.3)
+        assert controller.limit == 2
+        assert controller.decisions[-1]['reason'] == 'latency'
+
+    def test_no_increase_below_limit(self):
+        controller = AIMD(initial=4, latency_tolerance=None)
+        for i in range(20):
+            controller.record(0.1, in_flight=2)
+        assert controller.limit == 4
+        for i in range(4):
+            controller.record(0.1, in_flight=4)
+        assert controller.limit == 5
+
+    def test_latency_target(self):
+        controller = AIMD(initial=4, latency_target=0.5)
+        controller.record(0.6)
+        assert controller.limit == 2
+
+
+def _assert_decreases(decisions, reason):
+    """Each decision made for the reason must have halved the limit.
+    """
+    decisions = list(decisions)
+    indexes = [
+        index for index, decision in enumerate(decisions)
+        if decision['reason'] == reason]
+    assert indexes
+    # the limit had been raised before congestion was first detected
+    assert indexes[0] > 0
+    for index in indexes:
+        if index:
+            previous = decisions[index - 1]['limit']
+            assert decisions[index]['limit'] == max(1, previous // 2)
+
+
+class TestAdaptiveDispatcher(object):
+    def _send(self, server, controller, count=150, connections=8, **kwargs):
+        dispatcher = backends.Dispatcher(
+            backends.SMTP, connections=connections, controller=controller,
+            host=server.host, port=server.port, **kwargs)
+        for i in range(count):
+            dispatcher.send(
+                Message('user{0}@test.com'.format(i), subject='Test'),
+                lane='bulk')
+        dispatcher.close()
+        return dispatcher
+
+    def test_backs_off_on_temporary_failures(self):
+        controller = AIMD(latency_tolerance=None, batch_size=5)
+        with LocalSMTPServer(capacity=3, load_latency=0.002) as server:
+            dispatcher = self._send(
+                server, controller, retries=20, retry_delay=0.001)
+        metrics = dispatcher.metrics['bulk']
+        # failures are retried by the dispatcher rather than failing
+        assert metrics['sent'] == 150
+        assert metrics['failed'] == 0
+        assert metrics['retried'] == controller.temporary_failures
+        assert len(server.messages) == 150
+        reasons = {decision['reason'] for decision in controller.decisions}
+        assert reasons == {'increase', 'temporary failure'}
+        _assert_decreases(controller.decisions, 'temporary failure')
+        # sessions are closed after each batch and new ones opened
+        assert server.connections > 8
+
+    def test_backs_off_on_latency(self):
+        controller = AIMD(latency_target=0.035, max_batch_size=1000)
+        with LocalSMTPServer(load_latency=0.01) as server:
+            dispatcher = self._send(server, controller, count=100)
+        assert dispatcher.metrics['bulk']['sent'] == 100
+        assert controller.temporary_failures == 0
+        _assert_decreases(controller.decisions, 'latency')
+
+    def test_reconnects_after_disconnect(self):
+        with LocalSMTPServer(messages_per_connection=1) as server:
+            dispatcher = self._send(server, AIMD(), count=3, connections=1)
+        assert dispatcher.metrics['bulk']['sent'] == 3
+        assert server.connections == 3
+
+    def test_retries_exhausted(self):
+        controller = AIMD()
+        with LocalSMTPServer(capacity=0) as server:
+            dispatcher = backends.Dispatcher(
+                backends.SMTP, connections=1, controller=controller,
+                retries=2, retry_delay=0.001, max_retries=1,
+                host=server.host, port=server.port)
+            future = dispatcher.send(Message('user@test.com'))
+            assert future.exception(timeout=5) is not None
+            dispatcher.close()
+        assert dispatcher.metrics['normal']['retried'] == 2
+        assert dispatcher.metrics['normal']['failed'] == 1
+        assert controller.temporary_failures == 3
+        assert server.commands.count('MAIL') == 3
+
+    def test_limit_capped_by_connections(self):
+        controller = AIMD(latency_tolerance=None)
+        with LocalSMTPServer() as server:
+            self._send(server, controller, count=300, connections=2)
+        assert controller.maximum == 2
+        assert controller.limit == 2
+        assert all(
+            decision['limit'] <= 2 for decision in controller.decisions)
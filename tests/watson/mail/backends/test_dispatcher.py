@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import mailbox
+import os
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from watson.mail import backends, Message
+from watson.mail.backends import abc
+from watson.mail.backends.dispatcher import Lane, LatencyStats
+from tests.watson.mail.support import LocalSMTPServer
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), *['..'] * 4))
+
+
+class SlowBackend(abc.Base):
+    """Records the order messages were sent in, taking `delay` seconds for
+    each one.
+    """
+    sent = []
+    lock = threading.Lock()
+
+    def __init__(self, delay=0.01):
+        self.delay = delay
+
+    def send(self, message):
+        time.sleep(self.delay)
+        with self.lock:
+            self.sent.append(message.subject)
+        return message.subject
+
+
+def _message(subject, backend=None):
+    return Message('user@test.com', subject=subject, backend=backend)
+
+
+class TestLatencyStats(object):
+    def test_summary(self):
+        stats = LatencyStats(size=10)
+        for value in range(1, 21):
+            stats.add(value)
+        summary = stats.summary()
+        assert summary['count'] == 20
+        assert summary['max'] == 20
+        assert summary['mean'] == 15.5
+        assert summary['p50'] == 16
+        assert summary['p95'] == 20
+
+    def test_empty(self):
+        assert LatencyStats().summary()['p95'] is None
+
+
+class TestDispatcher(object):
+    def setup_method(self, method):
+        SlowBackend.sent = []
+
+    def test_send_returns_future(self):
+        dispatcher = backends.Dispatcher(SlowBackend, connections=2)
+        future = dispatcher.send(_message('one'))
+        assert future.result(timeout=5) == 'one'
+        dispatcher.close()
+        assert dispatcher.metrics['normal']['sent'] == 1
+
+    def test_message_send_uses_default_lane(self):
+        dispatcher = backends.Dispatcher(
+            SlowBackend, connections=1, default_lane='bulk')
+        future = _message('one', backend=dispatcher).send()
+        assert future.result(timeout=5) == 'one'
+        dispatcher.close()
+        assert dispatcher.metrics['bulk']['sent'] == 1
+
+    def test_closed_at_exit(self, tmpdir):
+        path = str(tmpdir)
+        script = (
+            'from watson.mail import backends, Message\n'
+            'dispatcher = backends.Dispatcher(\n'
+            '    backends.Maildir, connections=2, path={0!r})\n'
+            'for i in range(20):\n'
+            '    dispatcher.send(Message("user@test.com"))\n').format(path)
+        # the dispatcher is never closed, the atexit hook must send them
+        subprocess.check_call([sys.executable, '-c', script], cwd=ROOT)
+        assert len(mailbox.Maildir(path)) == 20
+
+    def test_transactional_not_starved(self):
+        dispatcher = backends.Dispatcher(SlowBackend, connections=2)
+        bulk = [
+            dispatcher.send(_message('bulk'), lane='bulk')
+            for i in range(50)]
+        time.sleep(0.05)
+        dispatcher.send(
+            _message('reset'), lane='transactional').result(timeout=5)
+        assert SlowBackend.sent.index('reset') < 10
+        dispatcher.close()
+        assert all(future.done() for future in bulk)
+        metrics = dispatcher.metrics
+        assert metrics['bulk']['sent'] == 50
+        assert metrics['transactional']['latency']['max'] < 0.1
+
+    def test_concurrency_limit(self):
+        active = []
+        peak = []
+
+        class Tracked(SlowBackend):
+            def send(self, message):
+                active.append(1)
+                peak.append(len(active))
+                try:
+                    return super(Tracked, self).send(message)
+                finally:
+                    active.pop()
+        dispatcher = backends.Dispatcher(
+            Tracked, connections=4,
+            lanes=[Lane('bulk', concurrency=2)], default_lane='bulk')
+        for i in range(20):
+            dispatcher.send(_message('bulk'))
+        dispatcher.close()
+        assert max(peak) == 2
+
+    def test_weighted(self):
+        dispatcher = backends.Dispatcher(
+            SlowBackend, connections=1, delay=0,
+            lanes=[Lane('high', weight=3), Lane('low', weight=1)])
+        with dispatcher._condition:
+            for i in range(8):
+                dispatcher.send(_message('high'), lane='high')
+                dispatcher.send(_message('low'), lane='low')
+        dispatcher.close()
+        assert SlowBackend.sent[:8].count('high') == 6
+
+    def test_strict(self):
+        dispatcher = backends.Dispatcher(
+            SlowBackend, connections=1, delay=0, strict=True,
+            lanes=[Lane('high'), Lane('low')])
+        with dispatcher._condition:
+            for i in range(4):
+                dispatcher.send(_message('low'), lane='low')
+                dispatcher.send(_message('high'), lane='high')
+        dispatcher.close()
+        assert SlowBackend.sent == ['high'] * 4 + ['low'] * 4
+
+    def test_failures(self):
+        dispatcher = backends.Dispatcher(
+            backends.SMTP, connections=1, host='127.0.0.1', port=1,
+            max_retries=1)
+        future = dispatcher.send(_message('one'))
+        assert future.exception(timeout=5) is not None
+        dispatcher.close()
+        assert dispatcher.metrics['normal']['failed'] == 1
+
+    def test_backend_error(self, tmpdir):
+        path = tmpdir.join('file')
+        path.write('')
+        with pytest.raises(OSError):
+            backends.Dispatcher(
+                backends.Maildir, connections=2, path=str(path))
+
+    def test_closed(self):
+        dispatcher = backends.Dispatcher(SlowBackend, connections=1)
+        dispatcher.close()
+        with pytest.raises(RuntimeError):
+            dispatcher.send(_message('one'))
+
+    def test_smtp_pool(self):
+        with LocalSMTPServer(latency=0.005) as server:
+            dispatcher = backends.Dispatcher(
+                backends.SMTP, connections=3, host=server.host,
+                port=server.port)
+            for i in range(12):
+                dispatcher.send(
+                    _message('bulk'), lane='bulk' if i % 2 else 'normal')
+            dispatcher.close()
+        assert len(server.messages) == 12
+        assert server.connections == 3
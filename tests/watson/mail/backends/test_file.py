@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import errno
+import mailbox
+import os
+import threading
+import pytest
+from email import generator
+from watson.mail import backends, Message
+from watson.mail.backends.file import CommitError
+
+
+def _message(backend, i=0, body='Test'):
+    return Message(
+        'user{0}@test.com'.format(i), from_='sender@test.com',
+        subject='Message {0}'.format(i), body=body, backend=backend)
+
+
+def _count_fsyncs(monkeypatch):
+    calls = []
+    fsync = os.fsync
+
+    def counted(fd):
+        calls.append(fd)
+        fsync(fd)
+    monkeypatch.setattr(os, 'fsync', counted)
+    return calls
+
+
+def _no_space(*args, **kwargs):
+    raise OSError(errno.ENOSPC, 'No space left on device')
+
+
+class TestMaildir(object):
+    def test_send(self, tmpdir):
+        path = str(tmpdir.join('Maildir'))
+        backend = backends.Maildir(path, batch_size=2)
+        backend.send(_message(backend, 0))
+        assert len(mailbox.Maildir(path)) == 0
+        assert len(os.listdir(os.path.join(path, 'tmp'))) == 1
+        assert backend.pending == 1
+        backend.send(_message(backend, 1))
+        assert len(os.listdir(os.path.join(path, 'tmp'))) == 0
+        assert backend.pending == 0
+        backend.send(_message(backend, 2))
+        backend.flush()
+        messages = sorted(
+            mailbox.Maildir(path), key=lambda message: message['Subject'])
+        assert [message['To'] for message in messages] == [
+            'user0@test.com', 'user1@test.com', 'user2@test.com']
+        assert messages[0]['From'] == 'sender@test.com'
+
+    def test_group_commit(self, tmpdir, monkeypatch):
+        fsyncs = _count_fsyncs(monkeypatch)
+        backend = backends.Maildir(str(tmpdir), batch_size=10)
+        for i in range(10):
+            backend.send(_message(backend, i))
+        # one per message plus a single fsync of the new directory
+        assert len(fsyncs) == 11
+
+    def test_concurrent_writers(self, tmpdir):
+        path = str(tmpdir)
+        writers = [backends.Maildir(path, batch_size=7) for i in range(4)]
+
+        def write(backend):
+            for i in range(25):
+                backend.send(_message(backend, i))
+            backend.quit()
+        threads = [
+            threading.Thread(target=write, args=(backend,))
+            for backend in writers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(mailbox.Maildir(path)) == 100
+        assert not os.listdir(os.path.join(path, 'tmp'))
+
+    def test_commit_failed(self, tmpdir, monkeypatch):
+        path = str(tmpdir)
+        backend = backends.Maildir(path, batch_size=3)
+        backend.send(_message(backend, 0))
+        backend.send(_message(backend, 1))
+        with monkeypatch.context() as patch:
+            patch.setattr(os, 'fsync', _no_space)
+            with pytest.raises(CommitError) as exc:
+                backend.send(_message(backend, 2))
+        assert exc.value.count == 3
+        assert backend.pending == 0
+        assert not os.listdir(os.path.join(path, 'tmp'))
+        assert not os.listdir(os.path.join(path, 'new'))
+        backend.send(_message(backend, 3))
+        backend.quit()
+        assert len(mailbox.Maildir(path)) == 1
+
+    def test_write_failed(self, tmpdir, monkeypatch):
+        path = str(tmpdir)
+        backend = backends.Maildir(path)
+
+        def flatten(self, message, *args, **kwargs):
+            self._fp.write(b'Subject: Partial')
+            _no_space()
+        monkeypatch.setattr(generator.BytesGenerator, 'flatten', flatten)
+        with pytest.raises(OSError):
+            backend.send(_message(backend, 0))
+        assert not os.listdir(os.path.join(path, 'tmp'))
+        assert backend.pending == 0
+
+    def test_abstract(self):
+        with pytest.raises(TypeError):
+            backends.file.File('path')
+
+
+class TestMbox(object):
+    def test_send(self, tmpdir):
+        path = str(tmpdir.join('mbox'))
+        backend = backends.Mbox(path)
+        backend.send(_message(backend, 0, body='From the start'))
+        backend.send(_message(backend, 1))
+        backend.quit()
+        messages = list(mailbox.mbox(path))
+        assert [message['Subject'] for message in messages] == [
+            'Message 0', 'Message 1']
+        assert messages[0].get_from().startswith('sender@test.com ')
+
+    def test_group_commit(self, tmpdir, monkeypatch):
+        fsyncs = _count_fsyncs(monkeypatch)
+        backend = backends.Mbox(str(tmpdir.join('mbox')), batch_size=50)
+        for i in range(100):
+            backend.send(_message(backend, i))
+        backend.quit()
+        assert len(fsyncs) == 2
+
+    def test_write_failed(self, tmpdir):
+        path = str(tmpdir.join('mbox'))
+        backend = backends.Mbox(path)
+        backend.send(_message(backend, 0))
+
+        class Full(object):
+            def __init__(self, f):
+                self.f = f
+
+            def fileno(self):
+                return self.f.fileno()
+
+            def write(self, data):
+                self.f.write(data[:10])
+                _no_space()
+        f = backend._file
+        backend._file = Full(f)
+        with pytest.raises(OSError):
+            backend.send(_message(backend, 1))
+        backend._file = f
+        backend.send(_message(backend, 2))
+        backend.quit()
+        assert [message['Subject'] for message in mailbox.mbox(path)] == [
+            'Message 0', 'Message 2']
+
+    def test_concurrent_writers(self, tmpdir):
+        path = str(tmpdir.join('mbox'))
+        writers = [backends.Mbox(path) for i in range(4)]
+
+        def write(backend):
+            for i in range(25):
+                backend.send(_message(backend, i))
+            backend.quit()
+        threads = [
+            threading.Thread(target=write, args=(backend,))
+            for backend in writers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        messages = list(mailbox.mbox(path))
+        assert len(messages) == 100
+        assert all(message['To'].startswith('user') for message in messages)
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+import pytest
 from watson.mail import Message, backends
+from watson.mail.backends.sendmail import SendmailError
 
 
 class TestSendmail(object):
@@ -14,3 +16,22 @@ class TestSendmail(object):
             backend=backend)
         command, message_string = backend._prepare_command('sendmail', message)
         assert command == 'sendmail test@test.com'
+
+    def test_recipients_quoted(self):
+        backend = backends.Sendmail()
+        message = Message(
+            ['one@test.com', 'a@b.com; rm -rf ~'], backend=backend)
+        command, message_string = backend._prepare_command('sendmail', message)
+        assert command == "sendmail one@test.com 'a@b.com; rm -rf ~'"
+
+    def test_option_like_recipient(self):
+        backend = backends.Sendmail()
+        message = Message('-C/etc/passwd', backend=backend)
+        with pytest.raises(ValueError):
+            backend._prepare_command('sendmail', message)
+
+    def test_command_failed(self):
+        backend = backends.Sendmail(command='echo unavailable >&2; exit 75;')
+        with pytest.raises(SendmailError) as exc:
+            backend.send(Message('test@test.com', backend=backend))
+        assert str(exc.value).endswith('exited with code 75: unavailable')
@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
 import smtplib
-from watson.mail import backends
+import pytest
+from watson.mail import backends, Message
+from tests.watson.mail.support import (
+    CERTIFICATE, KEY, LocalSMTPServer, client_ssl_context, server_ssl_context)
+
+
+def _message(backend, to):
+    return Message(
+        to, from_='sender@test.com', subject='Testing', body='Test',
+        backend=backend)
 
 
 class TestSMTP(object):
@@ -9,3 +18,173 @@ class TestSMTP(object):
         assert backend.smtp_class == smtplib.SMTP_SSL
         backend = backends.SMTP()
         assert backend.smtp_class == smtplib.SMTP
+
+    def test_send(self):
+        with LocalSMTPServer() as server:
+            backend = backends.SMTP(host=server.host, port=server.port)
+            refused = backend.send(
+                _message(backend, ['one@test.com', 'two@test.com']))
+            backend.quit()
+        assert refused == {}
+        sender, recipients, data = server.messages[0]
+        assert sender == 'sender@test.com'
+        assert recipients == ['one@test.com', 'two@test.com']
+        assert 'Subject: Testing' in data
+
+    def test_send_after_quit(self):
+        with LocalSMTPServer() as server:
+            backend = backends.SMTP(host=server.host, port=server.port)
+            backend.send(_message(backend, 'one@test.com'), should_quit=True)
+            backend.send(_message(backend, 'two@test.com'))
+            backend.quit()
+        assert server.connections == 2
+        assert len(server.messages) == 2
+
+    def test_skips_auth_without_username(self):
+        with LocalSMTPServer(extensions=('PIPELINING',)) as server:
+            backend = backends.SMTP(host=server.host, port=server.port)
+            backend.send(_message(backend, 'one@test.com'))
+            backend.quit()
+        assert 'AUTH' not in server.commands
+        assert len(server.messages) == 1
+
+
+class TestReconnect(object):
+    def test_idle_connection_replaced(self):
+        with LocalSMTPServer() as server:
+            backend = backends.SMTP(
+                host=server.host, port=server.port, idle_timeout=60)
+            backend.send(_message(backend, 'one@test.com'))
+            assert not backend.idle
+            backend._last_used -= 61
+            assert backend.idle
+            backend.send(_message(backend, 'two@test.com'))
+            backend.quit()
+        assert server.connections == 2
+        assert len(server.messages) == 2
+
+    def test_idle_timeout_disabled(self):
+        with LocalSMTPServer() as server:
+            backend = backends.SMTP(
+                host=server.host, port=server.port, idle_timeout=None)
+            backend.send(_message(backend, 'one@test.com'))
+            backend._last_used -= 3600
+            backend.send(_message(backend, 'two@test.com'))
+            backend.quit()
+        assert server.connections == 1
+
+    def test_ssl_session_resumed(self):
+        context = client_ssl_context()
+        with LocalSMTPServer(ssl_context=server_ssl_context()) as server:
+            first = backends.SMTP(
+                host=server.host, port=server.port, use_ssl=True,
+                username='user', password='password', ssl_context=context)
+            first.send(_message(first, 'one@test.com'))
+            assert not first._smtp.sock.session_reused
+            first.quit()
+            second = backends.SMTP(
+                host=server.host, port=server.port, use_ssl=True,
+                username='user', password='password', ssl_context=context)
+            second.send(_message(second, 'two@test.com'))
+            assert second._smtp.sock.session_reused
+            second.quit()
+        assert len(server.messages) == 2
+
+    def test_starttls_session_resumed(self):
+        context = client_ssl_context()
+        with LocalSMTPServer(
+                extensions=('STARTTLS', 'PIPELINING', 'AUTH PLAIN'),
+                ssl_context=server_ssl_context()) as server:
+            backend = backends.SMTP(
+                host=server.host, port=server.port, start_tls=True,
+                username='user', password='password', ssl_context=context)
+            backend.send(_message(backend, 'one@test.com'))
+            assert not backend._smtp.sock.session_reused
+            backend.quit()
+            commands = len(server.commands)
+            backend.send(_message(backend, 'two@test.com'))
+            assert backend._smtp.sock.session_reused
+            backend.quit()
+        assert server.commands[commands:commands + 3] == [
+            'EHLO', 'STARTTLS', 'EHLO']
+        assert len(server.messages) == 2
+
+    def test_ehlo_before_starttls(self):
+        context = client_ssl_context()
+        with LocalSMTPServer(
+                extensions=('STARTTLS', 'PIPELINING', 'AUTH PLAIN'),
+                ssl_context=server_ssl_context(),
+                require_ehlo=True) as server:
+            backend = backends.SMTP(
+                host=server.host, port=server.port, start_tls=True,
+                username='user', password='password', ssl_context=context)
+            for i in range(3):
+                backend.send(_message(backend, 'one@test.com'))
+                backend.quit()
+        assert server.commands.count('STARTTLS') == 3
+        assert len(server.messages) == 3
+
+    def test_client_certificate(self):
+        with LocalSMTPServer(ssl_context=server_ssl_context()) as server:
+            backend = backends.SMTP(
+                host=server.host, port=server.port, use_ssl=True,
+                keyfile=KEY, certfile=CERTIFICATE)
+            backend.send(_message(backend, 'one@test.com'))
+            backend.quit()
+        assert len(server.messages) == 1
+
+    def test_client_certificate_with_context(self):
+        with pytest.raises(ValueError):
+            backends.SMTP(
+                use_ssl=True, ssl_context=client_ssl_context(),
+                keyfile=KEY, certfile=CERTIFICATE)
+
+
+class TestPipelining(object):
+    def _reads_for_send(self, server, pipelining):
+        backend = backends.SMTP(
+            host=server.host, port=server.port, pipelining=pipelining)
+        backend._login()
+        reads = server.reads
+        backend.send(_message(
+            backend, ['user{0}@test.com'.format(i) for i in range(10)]))
+        reads = server.reads - reads
+        backend.quit()
+        return reads
+
+    def test_reduces_round_trips(self):
+        with LocalSMTPServer(latency=0.01) as server:
+            pipelined = self._reads_for_send(server, pipelining=True)
+            unpipelined = self._reads_for_send(server, pipelining=False)
+        assert pipelined == 2
+        assert unpipelined >= 13
+        assert len(server.messages) == 2
+        assert server.messages[0][1] == server.messages[1][1]
+
+    def test_not_advertised(self):
+        with LocalSMTPServer(extensions=('AUTH PLAIN',)) as server:
+            assert self._reads_for_send(server, pipelining=True) >= 13
+        assert len(server.messages) == 1
+
+    def test_refused_recipients(self):
+        with LocalSMTPServer(refuse=('bad@test.com',)) as server:
+            backend = backends.SMTP(host=server.host, port=server.port)
+            refused = backend.send(
+                _message(backend, ['good@test.com', 'bad@test.com']))
+            backend.quit()
+        assert list(refused) == ['bad@test.com']
+        assert refused['bad@test.com'][0] == 550
+        assert server.messages[0][1] == ['good@test.com']
+
+    def test_all_recipients_refused(self):
+        with LocalSMTPServer(refuse=('bad@test.com',)) as server:
+            backend = backends.SMTP(host=server.host, port=server.port)
+            backend._login()
+            with pytest.raises(smtplib.SMTPRecipientsRefused) as exc:
+                backend._pipeline(
+                    'sender@test.com', ['bad@test.com'], 'Subject: Test')
+            assert exc.value.recipients['bad@test.com'][0] == 550
+            # the connection remains usable after the failed transaction
+            assert backend.send(_message(backend, 'good@test.com')) == {}
+            backend.quit()
+        assert len(server.messages) == 1
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+import os
+import socketserver
+import ssl
+import threading
+import time
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+CERTIFICATE = os.path.join(FIXTURES, 'localhost.crt')
+KEY = os.path.join(FIXTURES, 'localhost.pem')
+
+
+def server_ssl_context():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(KEY)
+    return context
+
+
+def client_ssl_context():
+    return ssl.create_default_context(cafile=CERTIFICATE)
+
+
+class LocalSMTPServer(object):
+    """A minimal SMTP server that runs in a background thread.
+
+    Every time the server has to wait on the client for more data it sleeps
+    for `latency` seconds and increments `reads`, which gives an indication
+    of the number of round trips a client has made.
+
+    Attributes:
+        latency (float): Seconds to delay after each read from the client
+        extensions (tuple): The EHLO extensions to advertise
+        refuse (tuple): Recipients that will be refused with a 550
+        ssl_context (ssl.SSLContext): Used for STARTTLS if advertised in
+            `extensions`, otherwise connections are wrapped in TLS immediately
+        require_ehlo (bool): Refuse STARTTLS with a 503 until EHLO is sent
+        capacity (int): The number of concurrent transactions allowed, any
+            more are refused with a 451 to simulate congestion
+        load_latency (float): Seconds to delay completing each transaction
+            for every transaction currently in progress
+        messages_per_connection (int): Close the connection once this many
+            messages have been delivered over it
+        messages (list): (from, recipients, data) for each delivered message
+        commands (list): The verb of each command received
+        reads (int): The number of reads made from clients
+        connections (int): The number of connections accepted
+    """
+
+    def __init__(
+            self,
+            latency=0,
+            extensions=('PIPELINING', 'SIZE', 'AUTH PLAIN'),
+            refuse=(),
+            ssl_context=None,
+            require_ehlo=False,
+            capacity=None,
+            load_latency=0,
+            messages_per_connection=None):
+        self.latency = latency
+        self.extensions = extensions
+        self.refuse = refuse
+        self.ssl_context = ssl_context
+        self.require_ehlo = require_ehlo
+        self.capacity = capacity
+        self.load_latency = load_latency
+        self.messages_per_connection = messages_per_connection
+        self.transactions = 0
+        self.messages = []
+        self.commands = []
+        self.reads = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.smtp = self
+        self._thread = None
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.01})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.smtp = self.server.smtp
+        self.buffer = b''
+        self.output = b''
+        self.in_transaction = False
+        self.greeted = False
+        self.delivered = 0
+        self.reset()
+        if self.smtp.ssl_context and 'STARTTLS' not in self.smtp.extensions:
+            self.request = self.smtp.ssl_context.wrap_socket(
+                self.request, server_side=True)
+        with self.smtp._lock:
+            self.smtp.connections += 1
+
+    def finish(self):
+        self.reset()
+        try:
+            self.flush()
+        except OSError:
+            pass
+
+    def reset(self):
+        self.sender = None
+        self.recipients = []
+        if self.in_transaction:
+            with self.smtp._lock:
+                self.smtp.transactions -= 1
+            self.in_transaction = False
+
+    def flush(self):
+        if self.output:
+            self.request.sendall(self.output)
+            self.output = b''
+
+    def readline(self):
+        while b'\r\n' not in self.buffer:
+            # replies are only sent once every pipelined command is handled
+            self.flush()
+            chunk = self.request.recv(65536)
+            if not chunk:
+                return None
+            if self.smtp.latency:
+                time.sleep(self.smtp.latency)
+            with self.smtp._lock:
+                self.smtp.reads += 1
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line.decode('ascii')
+
+    def reply(self, code, *lines):
+        lines = lines or ('OK',)
+        response = ''.join(
+            '{0}{1}{2}\r\n'.format(
+                code, ' ' if index == len(lines) - 1 else '-', line)
+            for index, line in enumerate(lines))
+        self.output += response.encode('ascii')
+
+    def handle(self):
+        self.reply(220, 'localhost ESMTP')
+        while True:
+            line = self.readline()
+            if line is None:
+                return
+            command, _, argument = line.partition(' ')
+            with self.smtp._lock:
+                self.smtp.commands.append(command.upper())
+            handler = getattr(self, 'do_' + command.upper(), None)
+            if handler is None:
+                self.reply(500, 'Command not recognized')
+            elif handler(argument) is False:
+                return
+
+    def do_EHLO(self, argument):
+        self.greeted = True
+        self.reply(250, 'localhost', *self.smtp.extensions)
+
+    def do_HELO(self, argument):
+        self.reply(250, 'localhost')
+
+    def do_STARTTLS(self, argument):
+        if self.smtp.require_ehlo and not self.greeted:
+            self.reply(503, 'Send EHLO first')
+            return
+        self.greeted = False
+        self.reply(220, 'Ready to start TLS')
+        self.flush()
+        self.request = self.smtp.ssl_context.wrap_socket(
+            self.request, server_side=True)
+
+    def do_AUTH(self, argument):
+        self.reply(235, 'Authentication successful')
+
+    def do_MAIL(self, argument):
+        self.reset()
+        with self.smtp._lock:
+            busy = self.smtp.capacity is not None and (
+                self.smtp.transactions >= self.smtp.capacity)
+            if not busy:
+                self.smtp.transactions += 1
+        if busy:
+            self.reply(451, 'Too busy, try again later')
+            return
+        self.in_transaction = True
+        self.sender = _address(argument)
+        self.reply(250)
+
+    def do_RCPT(self, argument):
+        if self.sender is None:
+            self.reply(503, 'Need MAIL command')
+            return
+        address = _address(argument)
+        if address in self.smtp.refuse:
+            self.reply(550, 'No such user')
+            return
+        self.recipients.append(address)
+        self.reply(250)
+
+    def do_DATA(self, argument):
+        if not self.recipients:
+            self.reply(554, 'No valid recipients')
+            return
+        self.reply(354, 'End data with <CR><LF>.<CR><LF>')
+        lines = []
+        while True:
+            line = self.readline()
+            if line is None:
+                return False
+            if line == '.':
+                break
+            lines.append(line[1:] if line.startswith('..') else line)
+        if self.smtp.load_latency:
+            time.sleep(self.smtp.load_latency * self.smtp.transactions)
+        with self.smtp._lock:
+            self.smtp.messages.append(
+                (self.sender, self.recipients, '\r\n'.join(lines)))
+        self.reset()
+        self.reply(250)
+        self.delivered += 1
+        if self.delivered == self.smtp.messages_per_connection:
+            return False
+
+    def do_RSET(self, argument):
+        self.reset()
+        self.reply(250)
+
+    def do_NOOP(self, argument):
+        self.reply(250)
+
+    def do_QUIT(self, argument):
+        self.reply(221, 'Bye')
+        return False
+
+
+def _address(argument):
+    _, _, address = argument.partition(':')
+    return address.split(' ')[0].strip('<>')
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import errno
+import getpass
+import json
+import mailbox
+import os
+import pytest
+from watson.mail import cli
+from tests.watson.mail.support import LocalSMTPServer
+
+
+def _write_jsonl(path, records):
+    path.write(''.join(json.dumps(record) + '\n' for record in records))
+    return str(path)
+
+
+def _messages(count):
+    return [{
+        'to': 'user{0}@test.com'.format(i),
+        'from': 'sender@test.com',
+        'subject': 'Message {0}'.format(i),
+        'body': 'Test'} for i in range(count)]
+
+
+def _args(server, input, *args):
+    return [input, '--host', server.host, '--port', str(server.port)] + list(
+        args)
+
+
+class TestPrepareMessageKwargs(object):
+    def test_record(self):
+        kwargs = cli.prepare_message_kwargs({
+            'to': 'one@test.com, two@test.com',
+            'from': 'sender@test.com',
+            'unused': 'value'})
+        assert kwargs == {
+            'to': ['one@test.com', 'two@test.com'],
+            'from_': 'sender@test.com'}
+
+    def test_template(self):
+        kwargs = cli.prepare_message_kwargs(
+            {'to': 'one@test.com', 'name': 'One'},
+            {'subject': 'Hello {name}', 'body': '<p>Hi {name}</p>'})
+        assert kwargs == {
+            'to': 'one@test.com',
+            'subject': 'Hello One',
+            'body': '<p>Hi One</p>'}
+
+
+class TestMain(object):
+    def test_send_jsonl(self, tmpdir, capsys):
+        input = _write_jsonl(tmpdir.join('messages.jsonl'), _messages(5))
+        with LocalSMTPServer() as server:
+            assert cli.main(_args(server, input)) == 0
+        assert len(server.messages) == 5
+        assert server.connections == 1
+        assert 'Sent 5 messages, 0 failed, 0 skipped' in capsys.readouterr().out
+
+    def test_sharded_workers(self, tmpdir):
+        input = _write_jsonl(tmpdir.join('messages.jsonl'), _messages(10))
+        log = str(tmpdir.join('progress.jsonl'))
+        with LocalSMTPServer() as server:
+            assert cli.main(_args(
+                server, input, '--workers', '3', '--log', log)) == 0
+        assert len(server.messages) == 10
+        assert server.connections == 3
+        assert cli.read_completed(log) == set(range(10))
+
+    def test_csv_template(self, tmpdir):
+        input = tmpdir.join('recipients.csv')
+        input.write('to,name\none@test.com,One\ntwo@test.com,Two\n')
+        template = tmpdir.join('template.json')
+        template.write(json.dumps({
+            'from': 'sender@test.com',
+            'subject': 'Hello {name}',
+            'body': 'Test'}))
+        with LocalSMTPServer() as server:
+            assert cli.main(_args(
+                server, str(input), '--template', str(template))) == 0
+        subjects = sorted(
+            data.split('Subject: ')[1].split('\r\n')[0]
+            for _, _, data in server.messages)
+        assert subjects == ['Hello One', 'Hello Two']
+
+    def test_resume(self, tmpdir, capsys):
+        input = _write_jsonl(tmpdir.join('messages.jsonl'), _messages(5))
+        log = tmpdir.join('progress.jsonl')
+        log.write(''.join((
+            json.dumps({'index': 0, 'status': 'sent'}) + '\n',
+            json.dumps({'index': 1, 'status': 'failed', 'error': 'E'}) + '\n',
+            '{"index": 2, "sta')))
+        with LocalSMTPServer() as server:
+            assert cli.main(_args(server, input, '--log', str(log))) == 0
+        assert sorted(recipients[0] for _, recipients, _ in server.messages) == [
+            'user1@test.com', 'user2@test.com', 'user3@test.com',
+            'user4@test.com']
+        assert 'skipped' in capsys.readouterr().out
+        assert cli.read_completed(str(log)) == set(range(5))
+
+    def test_sendmail(self, tmpdir):
+        input = _write_jsonl(tmpdir.join('messages.jsonl'), _messages(2))
+        output = tmpdir.join('sent.txt')
+        command = 'sh -c \'cat >> {0}\' sendmail'.format(output)
+        assert cli.main(
+            [input, '--backend', 'sendmail', '--command', command]) == 0
+        assert output.read().count('Subject: Message') == 2
+
+    def test_sendmail_failed(self, tmpdir, capsys):
+        input = _write_jsonl(tmpdir.join('messages.jsonl'), _messages(2))
+        log = str(tmpdir.join('progress.jsonl'))
+        assert cli.main([
+            input, '--backend', 'sendmail', '--command', 'false',
+            '--log', log]) == 1
+        assert 'Sent 0 messages, 2 failed' in capsys.readouterr().out
+        assert cli.read_completed(log) == set()
+
+    def test_maildir(self, tmpdir):
+        input = _write_jsonl(tmpdir.join('messages.jsonl'), _messages(6))
+        path = str(tmpdir.join('Maildir'))
+        assert cli.main([
+            input, '--backend', 'maildir', '--path', path,
+            '--workers', '2']) == 0
+        assert len(mailbox.Maildir(path)) == 6
+
+    def test_results_held_until_committed(self, tmpdir):
+        input = _write_jsonl(tmpdir.join('messages.jsonl'), _messages(150))
+        path = str(tmpdir.join('Maildir'))
+        options = cli.parse_args(
+            [input, '--backend', 'maildir', '--path', path])
+        delivered = []
+
+        def report(result):
+            # by the time a result is reported the message has been committed
+            delivered.append(result['index'])
+            assert len(mailbox.Maildir(path)) >= len(delivered)
+        cli.send_shard(0, 1, options, set(), report)
+        assert delivered == list(range(150))
+
+    def test_commit_failed(self, tmpdir, monkeypatch):
+        input = _write_jsonl(tmpdir.join('messages.jsonl'), _messages(150))
+        path = str(tmpdir.join('Maildir'))
+        options = cli.parse_args(
+            [input, '--backend', 'maildir', '--path', path])
+        fsync = os.fsync
+        calls = []
+
+        def full_once(fd):
+            calls.append(fd)
+            if len(calls) == 1:
+                raise OSError(errno.ENOSPC, 'No space left on device')
+            fsync(fd)
+        monkeypatch.setattr(os, 'fsync', full_once)
+        results = []
+        cli.send_shard(0, 1, options, set(), results.append)
+        # the first batch of 100 was lost, the remainder were committed
+        assert [result['index'] for result in results] == list(range(150))
+        assert {result['status'] for result in results[:100]} == {'failed'}
+        assert results[0]['error'].startswith('CommitError')
+        assert {result['status'] for result in results[100:]} == {'sent'}
+        assert len(mailbox.Maildir(path)) == 50
+        assert not os.listdir(os.path.join(path, 'tmp'))
+
+    def test_malformed_lines(self, tmpdir, capsys):
+        input = tmpdir.join('messages.jsonl')
+        input.write(''.join((
+            json.dumps(_messages(1)[0]) + '\n',
+            '{"to": "broken@test.com"\n',
+            json.dumps(_messages(3)[2]) + '\n',
+            '["not", "a", "message"]\n')))
+        for workers in ('1', '2'):
+            log = str(tmpdir.join('progress{0}.jsonl'.format(workers)))
+            with LocalSMTPServer() as server:
+                assert cli.main(_args(
+                    server, str(input), '--workers', workers,
+                    '--log', log)) == 1
+            assert len(server.messages) == 2
+            assert 'Sent 2 messages, 2 failed' in capsys.readouterr().out
+            assert cli.read_completed(log) == {0, 2}
+
+    def test_invalid_utf8(self, tmpdir, capsys):
+        messages = _messages(3)
+        input = tmpdir.join('messages.jsonl')
+        input.write_binary(b''.join((
+            json.dumps(messages[0]).encode('utf-8') + b'\n',
+            b'{"to": "user1@test.com", "subject": "\xff"}\n',
+            json.dumps(messages[2]).encode('utf-8') + b'\n')))
+        csv_input = tmpdir.join('messages.csv')
+        csv_input.write_binary(b''.join((
+            b'to,subject\n',
+            b'user0@test.com,Caf\xc3\xa9\n',
+            b'user1@test.com,\xff\n',
+            b'user2@test.com,Test\n')))
+        for path in (input, csv_input):
+            log = str(tmpdir.join('progress.jsonl'))
+            with LocalSMTPServer() as server:
+                assert cli.main(_args(server, str(path), '--log', log)) == 1
+            assert len(server.messages) == 2
+            out = capsys.readouterr().out
+            assert 'Sent 2 messages, 1 failed' in out
+            assert 'UnicodeDecodeError: 1' in out
+            tmpdir.join('progress.jsonl').remove()
+
+    def test_worker_crashed(self, tmpdir, capsys):
+        input = _write_jsonl(tmpdir.join('messages.jsonl'), _messages(2))
+        template = str(tmpdir.join('missing.json'))
+        for workers in ('1', '2'):
+            with LocalSMTPServer() as server:
+                assert cli.main(_args(
+                    server, input, '--workers', workers,
+                    '--template', template)) == 1
+            out = capsys.readouterr().out
+            assert '{0} workers exited abnormally'.format(workers) in out
+            assert 'FileNotFoundError: {0}'.format(workers) in out
+
+    def test_failures(self, tmpdir, capsys):
+        input = _write_jsonl(tmpdir.join('messages.jsonl'), _messages(3))
+        with LocalSMTPServer(refuse=('user1@test.com',)) as server:
+            assert cli.main(_args(server, input)) == 1
+        assert len(server.messages) == 2
+        out = capsys.readouterr().out
+        assert 'Sent 2 messages, 1 failed' in out
+        assert 'SMTPMaxRetryError: 1' in out
+
+
+class TestPassword(object):
+    def test_environment(self, monkeypatch):
+        monkeypatch.setenv(cli.PASSWORD_VARIABLE, 'secret')
+        options = cli.parse_args(['input.jsonl', '--username', 'user'])
+        assert options.password == 'secret'
+
+    def test_prompt(self, monkeypatch):
+        monkeypatch.delenv(cli.PASSWORD_VARIABLE, raising=False)
+        monkeypatch.setattr(getpass, 'getpass', lambda prompt: 'prompted')
+        options = cli.parse_args(['input.jsonl', '--username', 'user'])
+        assert options.password == 'prompted'
+
+    def test_not_required(self, monkeypatch):
+        monkeypatch.setattr(getpass, 'getpass', None)
+        assert cli.parse_args(['input.jsonl']).password is None
+
+    def test_argument_removed(self):
+        with pytest.raises(SystemExit):
+            cli.parse_args(['input.jsonl', '--password', 'secret'])
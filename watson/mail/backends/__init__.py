@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+from watson.mail.backends.dispatcher import Dispatcher, Lane
+from watson.mail.backends.file import Maildir, Mbox
 from watson.mail.backends.sendmail import Sendmail
 from watson.mail.backends.smtp import SMTP
 
-__all__ = ('Sendmail', 'SMTP')
+__all__ = ('Dispatcher', 'Lane', 'Maildir', 'Mbox', 'Sendmail', 'SMTP')
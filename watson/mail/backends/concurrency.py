@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import collections
+import smtplib
+import socket
+import threading
+import time
+
+
+def is_temporary_failure(exc):
+    """Determine whether an exception indicates that the server is
+    congested (a 4xx response, a dropped connection or a timeout) rather
+    than the message being permanently rejected.
+    """
+    while exc is not None:
+        if isinstance(exc, smtplib.SMTPRecipientsRefused):
+            return bool(exc.recipients) and all(
+                400 <= code < 500 for code, resp in exc.recipients.values())
+        if isinstance(exc, smtplib.SMTPResponseException):
+            return 400 <= exc.smtp_code < 500
+        if isinstance(exc, (
+                smtplib.SMTPServerDisconnected, ConnectionError,
+                socket.timeout)):
+            return True
+        exc = exc.__cause__
+    return False
+
+
+class AIMD(object):
+    """Tunes the number of concurrent deliveries, and the number of messages
+    sent per session, using additive increase/multiplicative decrease.
+
+    For every `limit` deliveries that complete without a sign of congestion
+    while the limit was fully used, the limit is increased by `increase`. A
+    temporary failure, or a delivery that took longer than
+    `latency_tolerance` times the fastest recent delivery (or
+    `latency_target` if given), multiplies the limit by `decrease`. Like
+    TCP, the limit is decreased at most once per window of `limit`
+    deliveries, so a burst of failures caused by the same overload only
+    reduces it once. The batch size follows the same rules. Set
+    `latency_tolerance` to None to only react to temporary failures.
+
+    Attributes:
+        limit (int): The number of deliveries that may run concurrently
+        batch_size (int): The number of messages to send per session
+        decisions (collections.deque): The most recent adjustments made
+    """
+    limit = None
+    batch_size = None
+    decisions = None
+
+    def __init__(
+            self,
+            initial=1,
+            minimum=1,
+            maximum=16,
+            increase=1,
+            decrease=0.5,
+            latency_target=None,
+            latency_tolerance=3.0,
+            batch_size=10,
+            max_batch_size=100):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.latency_tolerance = latency_tolerance
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.decisions = collections.deque(maxlen=100)
+        self.deliveries = 0
+        self.temporary_failures = 0
+        self._latencies = collections.deque(maxlen=100)
+        self._successes = 0
+        self._since_decrease = None
+        self._lock = threading.Lock()
+
+    @property
+    def metrics(self):
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'batch_size': self.batch_size,
+                'deliveries': self.deliveries,
+                'temporary_failures': self.temporary_failures,
+                'decisions': list(self.decisions)
+            }
+
+    def record(self, latency, temporary_failure=False, in_flight=None):
+        """Record the outcome of a delivery and adjust the limits.
+
+        Args:
+            latency (float): The time taken to perform the delivery
+            temporary_failure (bool): Whether the delivery failed temporarily
+            in_flight (int): The number of deliveries in progress (including
+                this one) when it completed, deliveries made while below the
+                limit say nothing about whether it can be raised
+        """
+        with self._lock:
+            self.deliveries += 1
+            if self._since_decrease is not None:
+                self._since_decrease += 1
+            if temporary_failure:
+                self.temporary_failures += 1
+                self._decrease('temporary failure')
+                return
+            slow = latency > self._latency_threshold()
+            self._latencies.append(latency)
+            if slow:
+                self._decrease('latency')
+                return
+            if in_flight is not None and in_flight < self.limit:
+                return
+            self._successes += 1
+            if self._successes >= self.limit:
+                self._successes = 0
+                if self.limit < self.maximum or (
+                        self.batch_size < self.max_batch_size):
+                    self.limit = min(self.maximum, self.limit + self.increase)
+                    self.batch_size = min(
+                        self.max_batch_size, self.batch_size + self.increase)
+                    self._decide('increase')
+
+    def _latency_threshold(self):
+        if self.latency_target is not None:
+            return self.latency_target
+        if self.latency_tolerance is None or not self._latencies:
+            return float('inf')
+        return min(self._latencies) * self.latency_tolerance
+
+    def _decrease(self, reason):
+        self._successes = 0
+        if self._since_decrease is not None and (
+                self._since_decrease < self.limit):
+            return
+        self._since_decrease = 0
+        self.limit = max(self.minimum, int(self.limit * self.decrease))
+        self.batch_size = max(1, int(self.batch_size * self.decrease))
+        self._decide(reason)
+
+    def _decide(self, reason):
+        self.decisions.append({
+            'time': time.time(),
+            'reason': reason,
+            'limit': self.limit,
+            'batch_size': self.batch_size
+        })
+
+    def __repr__(self):
+        return '<{0} limit:{1} batch_size:{2}>'.format(
+            self.__class__.__name__, self.limit, self.batch_size)
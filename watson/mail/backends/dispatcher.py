@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+import atexit
+import collections
+import threading
+import time
+from concurrent import futures
+from watson.mail.backends import abc, concurrency
+
+# Dispatchers that have not been closed, so that their queued messages are
+# still sent if the process exits without closing them.
+_open = set()
+_open_lock = threading.Lock()
+
+
+class Lane(object):
+    """A queue of messages that share a priority.
+
+    Attributes:
+        name (string): The name used to send messages via the lane
+        weight (int): The relative share of connections the lane receives
+        concurrency (int): The maximum number of messages from the lane that
+            can be sent at once, None for no limit
+        latency (LatencyStats): Time taken from queuing to sending each message
+        retried (int): The number of deliveries queued again after failing
+            temporarily
+    """
+    name = None
+    weight = 1
+    concurrency = None
+    queue = None
+    active = 0
+    sent = 0
+    failed = 0
+    retried = 0
+    latency = None
+    _current_weight = 0
+
+    def __init__(self, name, weight=1, concurrency=None):
+        self.name = name
+        self.weight = weight
+        self.concurrency = concurrency
+        self.queue = collections.deque()
+        self.latency = LatencyStats()
+
+    @property
+    def ready(self):
+        """Whether or not a message can be taken from the lane.
+        """
+        return bool(self.queue) and (
+            self.concurrency is None or self.active < self.concurrency)
+
+    @property
+    def metrics(self):
+        return {
+            'queued': len(self.queue),
+            'active': self.active,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'latency': self.latency.summary()
+        }
+
+    def __repr__(self):
+        return '<{0} name:{1} weight:{2} queued:{3}>'.format(
+            self.__class__.__name__, self.name, self.weight, len(self.queue))
+
+
+class LatencyStats(object):
+    """Tracks latency over the most recent samples.
+    """
+
+    def __init__(self, size=1000):
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0
+        self.max = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+    def summary(self):
+        mean = None
+        if self.samples:
+            mean = sum(self.samples) / len(self.samples)
+        return {
+            'count': self.count,
+            'mean': mean,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'max': self.max
+        }
+
+
+def default_lanes(connections):
+    """The transactional, normal and bulk lanes, in order of priority.
+
+    Bulk mail is prevented from occupying every connection so that one is
+    always available for more urgent messages.
+    """
+    return [
+        Lane('transactional', weight=10),
+        Lane('normal', weight=3),
+        Lane('bulk', weight=1, concurrency=max(1, connections - 1))
+    ]
+
+
+class Dispatcher(abc.Base):
+    """Send messages through a pool of backends, prioritised by lane.
+
+    Each connection in the pool is a separate instance of the backend,
+    owned by its own thread. Whenever a connection becomes free the next
+    message is taken from the highest priority lane (if `strict`), or from
+    the lanes in proportion to their weight using smooth weighted
+    round-robin, skipping any lane that has reached its concurrency limit.
+
+    If a `controller` (such as `concurrency.AIMD`) is given, it decides how
+    many of the connections may be sending at once and how many messages
+    each connection sends before its session is closed, adapting both to
+    the latency and temporary failures of each delivery. The controller's
+    maximum is capped at the number of connections. A message that fails
+    temporarily is reported to the controller and put back in its lane
+    after `retry_delay` seconds, doubling for each attempt, and its future
+    only fails once it has been retried `retries` times.
+
+    `close()` should be called once all messages have been queued. Any
+    dispatcher that is still open when the interpreter exits is closed by
+    an atexit hook, which waits for its queued messages to be sent.
+
+    Example:
+
+        .. code-block:: python
+
+            from watson.mail import backends, Message
+
+            dispatcher = backends.Dispatcher(
+                backends.SMTP, connections=4, host='smtp.example.com')
+            dispatcher.send(Message(to='user@email.com'), lane='transactional')
+            Message(to='user@email.com', backend=dispatcher).send()  # normal
+            dispatcher.close()
+    """
+    lanes = None
+    strict = False
+    default_lane = 'normal'
+    controller = None
+    retries = 3
+    retry_delay = 1.0
+    _closed = False
+
+    def __init__(
+            self,
+            backend,
+            connections=4,
+            lanes=None,
+            strict=False,
+            default_lane='normal',
+            controller=None,
+            retries=3,
+            retry_delay=1.0,
+            **kwargs):
+        """Initialise the dispatcher.
+
+        Args:
+            backend (callable): Creates a backend for each connection, any
+                exception it raises is raised from here
+            connections (int): The number of connections in the pool
+            lanes (list): The Lanes to dispatch from, in order of priority
+            strict (bool): Always favour higher priority lanes over weighting
+            default_lane (string): The lane used when none is specified
+            controller (concurrency.AIMD): Adjusts the concurrency limit
+            retries (int): How many times a message that fails temporarily
+                is queued again when a controller is given
+            retry_delay (float): Seconds to wait before the first retry
+            kwargs: Passed to `backend` when creating each connection
+        """
+        self.lanes = collections.OrderedDict(
+            (lane.name, lane) for lane in lanes or default_lanes(connections))
+        self.strict = strict
+        self.default_lane = default_lane
+        self.controller = controller
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._delayed = []
+        self._condition = threading.Condition()
+        # created up front so that a misconfigured backend raises here rather
+        # than silently killing the threads that would send queued messages
+        pool = [backend(**kwargs) for connection in range(connections)]
+        if controller:
+            controller.maximum = min(controller.maximum, connections)
+            controller.limit = min(controller.limit, controller.maximum)
+        self._threads = [
+            threading.Thread(target=self._work, args=(instance,), daemon=True)
+            for instance in pool]
+        for thread in self._threads:
+            thread.start()
+        with _open_lock:
+            _open.add(self)
+
+    @property
+    def metrics(self):
+        """The current state and latency of each lane.
+        """
+        with self._condition:
+            return {name: lane.metrics for name, lane in self.lanes.items()}
+
+    def send(self, message, lane=None):
+        """Queue the message for sending.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the result of the backend
+        """
+        future = futures.Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Cannot send via a closed dispatcher.')
+            self.lanes[lane or self.default_lane].queue.append(
+                (message, future, time.monotonic(), 0))
+            self._condition.notify()
+        return future
+
+    def close(self):
+        """Wait for all queued messages to be sent, then close each
+        connection.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        with _open_lock:
+            _open.discard(self)
+
+    def quit(self):
+        self.close()
+
+    def _next_lane(self):
+        if self.controller and sum(
+                lane.active for lane in self.lanes.values()
+        ) >= self.controller.limit:
+            return None
+        ready = [lane for lane in self.lanes.values() if lane.ready]
+        if not ready or self.strict:
+            return ready[0] if ready else None
+        total = 0
+        for lane in ready:
+            lane._current_weight += lane.weight
+            total += lane.weight
+        lane = max(ready, key=lambda lane: lane._current_weight)
+        lane._current_weight -= total
+        return lane
+
+    def _release_delayed(self):
+        """Return retries whose delay has passed to the front of their lane.
+
+        Returns:
+            float: Seconds until the next retry is due, None if there are none
+        """
+        now = time.monotonic()
+        delayed = []
+        for due, lane, item in self._delayed:
+            if due <= now:
+                lane.queue.appendleft(item)
+            else:
+                delayed.append((due, lane, item))
+        self._delayed = delayed
+        if delayed:
+            return min(due for due, lane, item in delayed) - now
+        return None
+
+    def _take(self):
+        with self._condition:
+            while True:
+                timeout = self._release_delayed()
+                lane = self._next_lane()
+                if lane:
+                    lane.active += 1
+                    return (lane,) + lane.queue.popleft()
+                if self._closed and not self._delayed and not any(
+                        lane.queue for lane in self.lanes.values()):
+                    return None
+                self._condition.wait(timeout)
+
+    def _work(self, backend):
+        session = 0
+        try:
+            while True:
+                item = self._take()
+                if item is None:
+                    return
+                lane, message, future, queued, attempt = item
+                status = None
+                temporary_failure = False
+                started = time.monotonic()
+                # a retried future is already running
+                if attempt or future.set_running_or_notify_cancel():
+                    session += 1
+                    try:
+                        future.set_result(backend.send(message))
+                        status = 'sent'
+                    except Exception as exc:
+                        temporary_failure = concurrency.is_temporary_failure(
+                            exc)
+                        if temporary_failure and self.controller and (
+                                attempt < self.retries):
+                            status = 'retried'
+                        else:
+                            future.set_exception(exc)
+                            status = 'failed'
+                finished = time.monotonic()
+                with self._condition:
+                    in_flight = sum(
+                        lane.active for lane in self.lanes.values())
+                    lane.active -= 1
+                    if status == 'retried':
+                        lane.retried += 1
+                        self._delayed.append((
+                            finished + self.retry_delay * 2 ** attempt, lane,
+                            (message, future, queued, attempt + 1)))
+                    elif status:
+                        lane.latency.add(finished - queued)
+                    if status == 'sent':
+                        lane.sent += 1
+                    elif status == 'failed':
+                        lane.failed += 1
+                    if status and self.controller:
+                        self.controller.record(
+                            finished - started, temporary_failure, in_flight)
+                    self._condition.notify_all()
+                if self.controller and (
+                        session >= self.controller.batch_size) and (
+                        hasattr(backend, 'quit')):
+                    backend.quit()
+                    session = 0
+        finally:
+            if hasattr(backend, 'quit'):
+                backend.quit()
+
+
+@atexit.register
+def _close_open():
+    with _open_lock:
+        dispatchers = list(_open)
+    for dispatcher in dispatchers:
+        dispatcher.close()
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+import io
+import itertools
+import os
+import socket
+import threading
+import time
+from abc import abstractmethod
+from email import generator
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+from watson.mail.backends import abc
+
+_counter = itertools.count()
+
+
+class CommitError(Exception):
+    """Raised when a batch of messages could not be committed, in which case
+    none of the messages in the batch should be considered sent.
+
+    Attributes:
+        count (int): The number of messages in the batch
+    """
+
+    def __init__(self, count, error):
+        super(CommitError, self).__init__(
+            'Unable to commit {0} messages: {1}'.format(count, error))
+        self.count = count
+
+
+class File(abc.Base):
+    """Base class for backends that write messages to the filesystem.
+
+    Messages are serialised straight to disk as they are sent, but are only
+    guaranteed to be durable once the batch they belong to is committed,
+    which happens every `batch_size` messages or when `flush()` is called.
+    This allows a single group of fsync calls to cover a batch of messages
+    rather than waiting on the disk for every message. `pending` reports
+    how many messages are still waiting to be committed. If a batch cannot
+    be committed, the messages written for it are discarded where possible
+    and CommitError is raised.
+    """
+
+    path = None
+    batch_size = None
+    fsync = True
+    _pending = None
+    _lock = None
+
+    def __init__(self, path, batch_size=100, fsync=True):
+        self.path = path
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        prepared = message.prepared
+        prepared['From'] = str(message.senders.from_.email)
+        pending = self._write(message, prepared)
+        with self._lock:
+            self._pending.append(pending)
+            if len(self._pending) < self.batch_size:
+                return
+            pending, self._pending = self._pending, []
+        self._commit_batch(pending)
+
+    @property
+    def pending(self):
+        """The number of messages written that are yet to be committed.
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Commit any messages that have been written since the last batch.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            self._commit_batch(pending)
+
+    def quit(self):
+        self.flush()
+
+    @abstractmethod
+    def _write(self, message, prepared):
+        raise NotImplementedError('_write must be implemented')
+
+    @abstractmethod
+    def _commit(self, pending):
+        raise NotImplementedError('_commit must be implemented')
+
+    def _discard(self, pending):
+        """Clean up after a batch that failed to commit.
+        """
+
+    def _commit_batch(self, pending):
+        try:
+            self._commit(pending)
+        except Exception as exc:
+            self._discard(pending)
+            raise CommitError(len(pending), exc) from exc
+
+    def __del__(self):
+        try:
+            self.quit()
+        except Exception:
+            pass
+
+
+class Maildir(File):
+    """Deliver messages into a Maildir.
+
+    Each message is written to the tmp directory and moved into new once its
+    batch has been committed, so readers will never see a partial message.
+    Multiple threads and processes can safely deliver into the same Maildir.
+    """
+
+    def __init__(self, path, batch_size=100, fsync=True, create=True):
+        super(Maildir, self).__init__(path, batch_size, fsync)
+        if create:
+            for directory in ('tmp', 'new', 'cur'):
+                os.makedirs(os.path.join(path, directory), exist_ok=True)
+
+    def _write(self, message, prepared):
+        name = _unique_name()
+        path = os.path.join(self.path, 'tmp', name)
+        f = open(path, 'xb')
+        try:
+            with f:
+                generator.BytesGenerator(
+                    f, mangle_from_=False).flatten(prepared)
+        except Exception:
+            os.remove(path)
+            raise
+        return name
+
+    def _commit(self, names):
+        if self.fsync:
+            for name in names:
+                _fsync(os.path.join(self.path, 'tmp', name))
+        for name in names:
+            os.rename(
+                os.path.join(self.path, 'tmp', name),
+                os.path.join(self.path, 'new', name))
+        if self.fsync:
+            _fsync(os.path.join(self.path, 'new'))
+
+    def _discard(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.path, 'tmp', name))
+            except FileNotFoundError:
+                pass  # moved into new before the commit failed
+
+
+class Mbox(File):
+    """Append messages to an mbox file.
+
+    The file is locked via flock while each message is appended, so multiple
+    threads and processes can safely write to the same mbox. A message that
+    fails part way through being appended is truncated from the file.
+    """
+
+    _file = None
+    _dirty = False
+
+    def _write(self, message, prepared):
+        buffer = io.BytesIO()
+        buffer.write('From {0} {1}\n'.format(
+            message.senders.from_.email or 'MAILER-DAEMON',
+            time.asctime(time.gmtime())).encode('ascii'))
+        generator.BytesGenerator(buffer, mangle_from_=True).flatten(prepared)
+        buffer.write(b'\n')
+        data = memoryview(buffer.getvalue())
+        with self._lock:
+            if not self._file:
+                self._file = open(self.path, 'ab', buffering=0)
+            f = self._file
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                position = os.lseek(f.fileno(), 0, os.SEEK_END)
+                try:
+                    while data:
+                        data = data[f.write(data):]
+                except Exception:
+                    os.ftruncate(f.fileno(), position)
+                    raise
+                self._dirty = True
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _commit(self, pending):
+        with self._lock:
+            self._sync()
+
+    def quit(self):
+        super(Mbox, self).quit()
+        with self._lock:
+            if self._file:
+                # a batch may have been written after the flush above
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def _sync(self):
+        if self.fsync and self._file and self._dirty:
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _unique_name():
+    now = time.time()
+    hostname = socket.gethostname().replace('/', r'\057').replace(':', r'\072')
+    return '{0}.M{1}P{2}Q{3}.{4}'.format(
+        int(now), int(now % 1 * 1e6), os.getpid(), next(_counter), hostname)
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
+import shlex
 import subprocess
 from watson.mail.backends import abc
 
 
+class SendmailError(Exception):
+    pass
+
+
 class Sendmail(abc.Base):
     """Send an email via the `sendmail` command.
+
+    Raises SendmailError if the command exits with a non-zero status.
     """
 
     command = None
@@ -19,20 +26,26 @@ class Sendmail(abc.Base):
                 command,
                 shell=True,
                 stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE)
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
         except (IOError, OSError):
             raise Exception('Unable to open pipe to sendmail.')
-        try:
-            process.stdin.write(message_string.encode(message.encoding))
-            process.stdin.close()
-        finally:
-            while process.poll() is None:
-                process.stdout.read(100)
-            process.stdout.close()
+        stdout, stderr = process.communicate(
+            message_string.encode(message.encoding))
+        if process.returncode:
+            raise SendmailError('{0} exited with code {1}: {2}'.format(
+                self.command, process.returncode,
+                stderr.decode('utf-8', 'replace').strip()))
 
     def _prepare_command(self, command, message):
         prepared = message.prepared
         prepared['From'] = str(message.senders.from_.email)
         message_string = prepared.as_string()
-        command = '{0} {1}'.format(command, str(message.recipients.to))
+        recipients = []
+        for address in message.recipients.to:
+            if not address.email or address.email.startswith('-'):
+                raise ValueError(
+                    'Invalid recipient address {0!r}'.format(address.email))
+            recipients.append(shlex.quote(address.email))
+        command = '{0} {1}'.format(command, ' '.join(recipients))
         return command, message_string
@@ -1,7 +1,19 @@
 # -*- coding: utf-8 -*-
+import re
 import smtplib
+import ssl
+import time
 from watson.mail.backends import abc
 
+CRLF = '\r\n'
+bCRLF = b'\r\n'
+EOLS_REGEX = re.compile(r'(?:\r\n|\n|\r(?!\n))')
+PERIODS_REGEX = re.compile(br'(?m)^\.')
+
+# Shared between backend instances within a process, keyed by (host, port).
+_tls_sessions = {}
+_default_ssl_context = None
+
 
 class SMTPMaxRetryError(Exception):
     pass
@@ -9,6 +21,18 @@ class SMTPMaxRetryError(Exception):
 
 class SMTP(abc.Base):
     """Send an email via SMTP.
+
+    If the server advertises the PIPELINING extension (RFC 2920) the MAIL,
+    RCPT and DATA commands for a message are written in a single batch and
+    their replies read back together, rather than waiting on a round trip
+    for each command.
+
+    TLS sessions are cached per host, so reconnecting (or connecting from a
+    new backend instance) resumes the previous TLS session rather than
+    performing a full handshake. A client certificate can be given via
+    `keyfile` and `certfile`, which are loaded into the SSLContext used.
+    Connections that have been idle for longer than `idle_timeout` seconds
+    are replaced before the server is likely to have dropped them.
     """
 
     host = None
@@ -17,11 +41,15 @@ class SMTP(abc.Base):
     password = None
     use_ssl = False
     start_tls = False
+    pipelining = True
+    ssl_context = None
+    idle_timeout = None
     kwargs = None
     max_retries = None
     _smtp = None
     _connected = False
     _retries = 1
+    _last_used = None
 
     def __init__(
             self,
@@ -32,6 +60,9 @@ class SMTP(abc.Base):
             use_ssl=False,
             start_tls=False,
             max_retries=5,
+            pipelining=True,
+            ssl_context=None,
+            idle_timeout=240,
             **kwargs):
         self.host = host
         self.port = port
@@ -40,27 +71,55 @@ class SMTP(abc.Base):
         self.use_ssl = use_ssl
         self.start_tls = start_tls
         self.max_retries = max_retries
+        self.pipelining = pipelining
+        self.ssl_context = ssl_context or kwargs.pop('context', None)
+        keyfile = kwargs.pop('keyfile', None)
+        certfile = kwargs.pop('certfile', None)
+        if keyfile or certfile:
+            if self.ssl_context:
+                raise ValueError(
+                    'ssl_context and keyfile/certfile are mutually exclusive')
+            self.ssl_context = _create_unverified_context()
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+        self.idle_timeout = idle_timeout
         self.kwargs = kwargs
 
     @property
     def smtp_class(self):
         return smtplib.SMTP if not self.use_ssl else smtplib.SMTP_SSL
 
+    @property
+    def idle(self):
+        """Whether or not the connection has been unused for longer than
+        `idle_timeout`.
+        """
+        if self.idle_timeout is None or self._last_used is None:
+            return False
+        return time.monotonic() - self._last_used > self.idle_timeout
+
     def quit(self):
         if self._smtp:
             try:
+                self._store_tls_session()
                 self._smtp.quit()
             except Exception:
                 pass
             self._smtp = None
+        self._connected = False
 
     def send(self, message, should_quit=False, **kwargs):
+        """Send the message.
+
+        Returns:
+            dict: The recipients that were refused by the server, mapped to
+                the (code, response) they were refused with.
+        """
         self._login()
         from_addr = message.senders.from_.email
-        to_addrs = str(message.recipients.to)
+        to_addrs = [address.email for address in message.recipients.to]
         msg = message.prepared.as_string()
         self._retries = 1
-        self._send(
+        return self._send(
             from_addr,
             to_addrs=to_addrs,
             message=msg,
@@ -69,8 +128,14 @@ class SMTP(abc.Base):
 
     def _send(self, from_addr, to_addrs, message, should_quit, **kwargs):
         try:
-            mail = self._smtp.sendmail(
-                from_addr=from_addr, to_addrs=to_addrs, msg=message, **kwargs)
+            self._smtp.ehlo_or_helo_if_needed()
+            if self.pipelining and self._smtp.has_extn('pipelining'):
+                refused = self._pipeline(
+                    from_addr, to_addrs=to_addrs, msg=message, **kwargs)
+            else:
+                refused = self._smtp.sendmail(
+                    from_addr=from_addr, to_addrs=to_addrs, msg=message,
+                    **kwargs)
         except smtplib.SMTPException as exc:
             if self._retries == self.max_retries:
                 raise SMTPMaxRetryError(
@@ -81,33 +146,166 @@ class SMTP(abc.Base):
                 self._connected = False
                 self._smtp = None
                 self._login()
-            self._send(
+            return self._send(
                 from_addr,
                 to_addrs=to_addrs,
                 message=message,
                 should_quit=should_quit,
                 **kwargs)
+        self._last_used = time.monotonic()
         if should_quit:
-            self._smtp.quit()
-            self._smtp = None
-        mail = False
-        return mail
+            self.quit()
+        return refused
+
+    def _pipeline(
+            self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        """Perform a mail transaction using PIPELINING.
+
+        Mirrors the behaviour and exceptions of `smtplib.SMTP.sendmail`, but
+        writes MAIL FROM, every RCPT TO and DATA in a single batch. Every
+        reply is read back before any of them are acted upon so the
+        connection stays in sync even when commands early in the batch fail.
+        """
+        smtp = self._smtp
+        if isinstance(msg, str):
+            msg = EOLS_REGEX.sub(CRLF, msg).encode('ascii')
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        mail_options = list(mail_options)
+        if smtp.has_extn('size'):
+            mail_options.append('size={0}'.format(len(msg)))
+        commands = ['mail FROM:{0}{1}'.format(
+            smtplib.quoteaddr(from_addr), _format_options(mail_options))]
+        commands.extend('rcpt TO:{0}{1}'.format(
+            smtplib.quoteaddr(addr), _format_options(rcpt_options))
+            for addr in to_addrs)
+        commands.append('data')
+        smtp.send(''.join(command + CRLF for command in commands))
+        replies = [smtp.getreply() for command in commands]
+        (mail_code, mail_resp), (data_code, data_resp) = replies[0], replies[-1]
+        refused = {
+            addr: reply for addr, reply in zip(to_addrs, replies[1:-1])
+            if reply[0] not in (250, 251)}
+        rejected = mail_code != 250 or len(refused) == len(to_addrs)
+        if data_code == 354 and rejected:
+            # The server is waiting on content that will never be sent,
+            # terminate it so that the transaction can be reset.
+            smtp.send(b'.' + bCRLF)
+            smtp.getreply()
+        if mail_code != 250:
+            self._abort(mail_code)
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+        if any(code == 421 for code, resp in refused.values()):
+            self._abort(421)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if len(refused) == len(to_addrs):
+            self._abort()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_code != 354:
+            self._abort(data_code)
+            raise smtplib.SMTPDataError(data_code, data_resp)
+        content = PERIODS_REGEX.sub(b'..', msg)
+        if not content.endswith(bCRLF):
+            content += bCRLF
+        smtp.send(content + b'.' + bCRLF)
+        code, resp = smtp.getreply()
+        if code != 250:
+            self._abort(code)
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def _abort(self, code=None):
+        """Reset the current transaction, or close the connection if the
+        server has signalled that it is shutting down.
+        """
+        if code == 421:
+            self._smtp.close()
+            return
+        try:
+            self._smtp.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
 
     def _login(self):
+        if self._connected and self.idle:
+            self.quit()
         if self._connected:
             return
         if not self._smtp:
-            self._smtp = self.smtp_class(
-                host=self.host, port=self.port, **self.kwargs)
+            self._smtp = self._connect()
         if self.start_tls:
             try:
-                self._smtp.ehlo()
-                self._smtp.starttls()
+                self._starttls()
             except smtplib.SMTPServerDisconnected:
                 self._smtp = None
                 self._login()
-        self._smtp.login(self.username, self.password)
+                return
+        self._smtp.ehlo_or_helo_if_needed()
+        if self.username:
+            self._smtp.login(self.username, self.password)
+        self._store_tls_session()
         self._connected = True
+        self._last_used = time.monotonic()
+
+    def _connect(self):
+        kwargs = dict(self.kwargs)
+        if self.use_ssl:
+            kwargs['context'] = self._tls_context()
+        return self.smtp_class(host=self.host, port=self.port, **kwargs)
+
+    def _starttls(self):
+        # starttls() sends EHLO first, as required by RFC 3207
+        return self._smtp.starttls(context=self._tls_context())
+
+    def _tls_context(self):
+        """Retrieve an SSLContext that will resume the last TLS session
+        negotiated with the host.
+        """
+        context = self.ssl_context or _get_default_ssl_context()
+        cached_context, session = _tls_sessions.get(
+            (self.host, self.port), (None, None))
+        return _ResumableContext(
+            context, session if cached_context is context else None)
+
+    def _store_tls_session(self):
+        sock = getattr(self._smtp, 'sock', None)
+        if isinstance(sock, ssl.SSLSocket) and sock.session:
+            _tls_sessions[(self.host, self.port)] = (
+                self.ssl_context or _get_default_ssl_context(), sock.session)
 
     def __del__(self):
         self.quit()
+
+
+class _ResumableContext(object):
+    """Wraps an ssl.SSLContext so that the sockets smtplib creates with it
+    attempt to resume an existing TLS session.
+    """
+
+    def __init__(self, context, session=None):
+        self.context = context
+        self.session = session
+
+    def wrap_socket(self, sock, **kwargs):
+        return self.context.wrap_socket(sock, session=self.session, **kwargs)
+
+
+def _get_default_ssl_context():
+    global _default_ssl_context
+    if _default_ssl_context is None:
+        _default_ssl_context = _create_unverified_context()
+    return _default_ssl_context
+
+
+def _create_unverified_context():
+    # matches the context smtplib uses when none is given
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def _format_options(options):
+    if not options:
+        return ''
+    return ' ' + ' '.join(options)
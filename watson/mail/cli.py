@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""Send messages in bulk from the command line.
+
+Messages are streamed from a JSONL or CSV file, one message per line/row,
+where each field maps to an argument of `watson.mail.Message`. Alternatively
+a JSON template can be given, in which case each line/row of the input is a
+recipient whose fields are substituted into the template via `str.format`.
+When a username is given, the password is read from the WATSON_MAIL_PASSWORD
+environment variable or prompted for, rather than passed as an argument.
+
+Example:
+
+    .. code-block:: console
+
+        watson-mail messages.jsonl --host smtp.example.com --workers 4 \\
+            --log progress.jsonl
+        watson-mail recipients.csv --template welcome.json --backend sendmail
+"""
+import argparse
+import collections
+import csv
+import getpass
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from watson.mail import backends
+from watson.mail.backends.file import CommitError
+from watson.mail.messages import Message
+
+MESSAGE_FIELDS = (
+    'to', 'from_', 'reply_to', 'cc', 'bcc', 'subject', 'body',
+    'alternative', 'encoding', 'send_as_base64', 'attachments')
+ADDRESS_FIELDS = ('to', 'reply_to', 'cc', 'bcc')
+PASSWORD_VARIABLE = 'WATSON_MAIL_PASSWORD'
+
+
+def read_records(path, format=None):
+    """Lazily read each record from a UTF-8 encoded JSONL or CSV file.
+
+    A line or row that cannot be parsed (or decoded) yields the exception
+    that was raised in place of the record, so that the remaining records
+    can still be read.
+
+    Args:
+        path (string): The path to the file
+        format (string): jsonl or csv, defaults to the file extension
+    """
+    if not format:
+        format = 'csv' if path.endswith('.csv') else 'jsonl'
+    # invalid bytes are decoded as surrogates so that they can be reported
+    # against the record they belong to rather than ending the iteration
+    with open(
+            path, newline='', encoding='utf-8',
+            errors='surrogateescape') as f:
+        if format == 'csv':
+            rows = csv.DictReader(f)
+            while True:
+                try:
+                    row = next(rows)
+                    record = {
+                        _check_utf8(key): _check_utf8(value)
+                        for key, value in row.items() if value}
+                except StopIteration:
+                    return
+                except (csv.Error, ValueError) as exc:
+                    record = exc
+                yield record
+        else:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(_check_utf8(line))
+                except ValueError as exc:
+                    record = exc
+                yield record
+
+
+def _check_utf8(value):
+    """Raise UnicodeDecodeError if text read with surrogateescape contained
+    invalid UTF-8.
+    """
+    if isinstance(value, str):
+        value.encode('utf-8', 'surrogateescape').decode('utf-8')
+    return value
+
+
+def read_completed(path):
+    """Retrieve the index of each message that was sent successfully
+    according to a previous progress log.
+    """
+    completed = set()
+    if not path or not os.path.exists(path):
+        return completed
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # a partial line written as a run was interrupted
+            if result.get('status') == 'sent':
+                completed.add(result['index'])
+    return completed
+
+
+def prepare_message_kwargs(record, template=None):
+    """Convert a record (and optional template) into the arguments used to
+    create the Message.
+    """
+    kwargs = {}
+    for field, value in (template or {}).items():
+        if isinstance(value, str):
+            value = value.format_map(record)
+        kwargs[field] = value
+    kwargs.update(record)
+    if 'from' in kwargs:
+        kwargs['from_'] = kwargs.pop('from')
+    for field in ADDRESS_FIELDS:
+        value = kwargs.get(field)
+        if isinstance(value, str) and ',' in value:
+            kwargs[field] = [address.strip() for address in value.split(',')]
+    return {
+        field: value for field, value in kwargs.items()
+        if field in MESSAGE_FIELDS}
+
+
+def create_backend(options):
+    if options.backend == 'sendmail':
+        return backends.Sendmail(command=options.command)
+    if options.backend == 'maildir':
+        return backends.Maildir(options.path)
+    if options.backend == 'mbox':
+        return backends.Mbox(options.path)
+    return backends.SMTP(
+        host=options.host,
+        port=options.port,
+        username=options.username,
+        password=options.password,
+        use_ssl=options.ssl,
+        start_tls=options.start_tls)
+
+
+def send_shard(shard, shards, options, completed, report):
+    """Send every message in the input that belongs to the shard.
+
+    Each shard reads the input independently and only sends the records
+    where index % shards == shard, so nothing is loaded into memory and no
+    messages need to be passed between processes.
+
+    Args:
+        shard (int): The shard to send
+        shards (int): The total number of shards
+        options (argparse.Namespace): The parsed command line options
+        completed (set): The indexes of messages that have already been sent
+        report (callable): Called with the result of each message
+    """
+    template = None
+    if options.template:
+        with open(options.template, encoding='utf-8') as f:
+            template = json.load(f)
+    backend = create_backend(options)
+    records = read_records(options.input, options.format)
+    # Backends that commit in batches (such as Maildir) hold results until
+    # the batch is committed, so that the progress log never claims a
+    # message was sent when it could still be lost.
+    held = []
+    try:
+        for index, record in enumerate(records):
+            if index % shards != shard or index in completed:
+                continue
+            started = time.perf_counter()
+            result = {'index': index, 'status': 'sent'}
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                message = Message(
+                    backend=backend,
+                    **prepare_message_kwargs(record, template))
+                refused = backend.send(message)
+            except Exception as exc:
+                result['status'] = 'failed'
+                result['error'] = _describe(exc)
+                if isinstance(exc, CommitError):
+                    # every held message was part of the lost batch
+                    _fail(held, result['error'])
+            else:
+                if refused:
+                    result['refused'] = {
+                        address: [code, _decode(response)]
+                        for address, (code, response) in refused.items()}
+            result['elapsed'] = round(time.perf_counter() - started, 6)
+            held.append(result)
+            if not getattr(backend, 'pending', 0):
+                for result in held:
+                    report(result)
+                held = []
+    finally:
+        error = None
+        try:
+            if hasattr(backend, 'quit'):
+                backend.quit()
+        except Exception as exc:
+            error = _describe(exc)
+        if error:
+            _fail(held, error)
+        for result in held:
+            report(result)
+
+
+def _fail(results, error):
+    for result in results:
+        if result['status'] == 'sent':
+            result['status'] = 'failed'
+            result['error'] = error
+
+
+def _worker(shard, shards, options, completed, results):
+    try:
+        send_shard(shard, shards, options, completed, results.put)
+    except Exception as exc:
+        results.put(_crashed(shard, _describe(exc)))
+    finally:
+        results.put(None)
+
+
+def _crashed(shard, error):
+    return {'shard': shard, 'status': 'crashed', 'error': error}
+
+
+def _describe(exc):
+    return '{0}: {1}'.format(type(exc).__name__, exc)
+
+
+def _open_log(path):
+    log = open(path, 'a', encoding='utf-8')
+    if log.tell():
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                # terminate a partial line left by an interrupted run
+                log.write('\n')
+    return log
+
+
+def _decode(response):
+    if isinstance(response, bytes):
+        return response.decode('utf-8', 'replace')
+    return response
+
+
+class Summary(object):
+    """Tracks the results of a run and writes them to the progress log.
+
+    Attributes:
+        sent (int): The number of messages sent
+        failed (int): The number of messages that could not be sent
+        skipped (int): The number of messages already sent by a previous run
+        refused (int): The number of recipients refused by the server
+        crashed (int): The number of workers that exited abnormally
+        errors (collections.Counter): The number of failures by error
+    """
+    sent = 0
+    failed = 0
+    crashed = 0
+    skipped = 0
+    refused = 0
+    errors = None
+
+    def __init__(self, log=None, skipped=0):
+        self.log = log
+        self.skipped = skipped
+        self.errors = collections.Counter()
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def __call__(self, result):
+        if result['status'] == 'sent':
+            self.sent += 1
+            self.refused += len(result.get('refused', ()))
+        elif result['status'] == 'crashed':
+            self.crashed += 1
+            self.errors[result['error'].split(':')[0]] += 1
+        else:
+            self.failed += 1
+            self.errors[result['error'].split(':')[0]] += 1
+        if self.log:
+            self.log.write(json.dumps(result) + '\n')
+            self.log.flush()
+
+    def __str__(self):
+        elapsed = self.elapsed
+        lines = [
+            'Sent {0} messages, {1} failed, {2} skipped in {3:.2f}s '
+            '({4:.1f} messages/s)'.format(
+                self.sent, self.failed, self.skipped, elapsed,
+                self.sent / elapsed if elapsed else 0)]
+        if self.refused:
+            lines.append('{0} recipients refused'.format(self.refused))
+        if self.crashed:
+            lines.append('{0} workers exited abnormally, some messages may '
+                         'not have been attempted'.format(self.crashed))
+        for error, count in self.errors.most_common():
+            lines.append('  {0}: {1}'.format(error, count))
+        return '\n'.join(lines)
+
+
+def run(options):
+    """Send all the messages specified by the options.
+
+    Returns:
+        Summary: The results of the run
+    """
+    completed = read_completed(options.log)
+    log = _open_log(options.log) if options.log else None
+    try:
+        summary = Summary(log, skipped=len(completed))
+        if options.workers == 1:
+            try:
+                send_shard(0, 1, options, completed, summary)
+            except Exception as exc:
+                summary(_crashed(0, _describe(exc)))
+            return summary
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=_worker,
+                args=(shard, options.workers, options, completed, results))
+            for shard in range(options.workers)]
+        for process in processes:
+            process.start()
+        finished = 0
+        while finished < len(processes):
+            try:
+                result = results.get(timeout=0.5)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    break
+                continue
+            if result is None:
+                finished += 1
+            else:
+                summary(result)
+        for shard, process in enumerate(processes):
+            process.join()
+            if process.exitcode:
+                summary(_crashed(
+                    shard, 'WorkerExit: exited with code {0}'.format(
+                        process.exitcode)))
+        return summary
+    finally:
+        if log:
+            log.close()
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog='watson-mail',
+        description='Send messages in bulk via SMTP or sendmail, or write '
+                    'them to a Maildir or mbox.')
+    parser.add_argument(
+        'input', help='JSONL or CSV file of messages, or recipients if '
+                      'a template is used')
+    parser.add_argument(
+        '--format', choices=('jsonl', 'csv'),
+        help='the format of the input, defaults to the file extension')
+    parser.add_argument(
+        '--template', help='JSON file of Message arguments, formatted with '
+                           'the fields of each input record')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='the number of processes to send with (default: 1)')
+    parser.add_argument(
+        '--log', help='file to record progress to, messages already sent '
+                      'according to the log are skipped')
+    parser.add_argument(
+        '--backend', choices=('smtp', 'sendmail', 'maildir', 'mbox'),
+        default='smtp')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=25)
+    parser.add_argument(
+        '--username', help='the password is read from the {0} environment '
+                           'variable, or prompted for'.format(
+                               PASSWORD_VARIABLE))
+    parser.add_argument('--ssl', action='store_true')
+    parser.add_argument('--start-tls', action='store_true')
+    parser.add_argument(
+        '--command', default='sendmail',
+        help='the sendmail command (default: sendmail)')
+    parser.add_argument(
+        '--path', help='the Maildir directory or mbox file to write to')
+    options = parser.parse_args(args)
+    if options.workers < 1:
+        parser.error('--workers must be at least 1')
+    if options.backend in ('maildir', 'mbox') and not options.path:
+        parser.error('--path is required for the {0} backend'.format(
+            options.backend))
+    options.password = None
+    if options.backend == 'smtp' and options.username:
+        options.password = os.environ.get(PASSWORD_VARIABLE)
+        if options.password is None:
+            options.password = getpass.getpass(
+                'Password for {0}: '.format(options.username))
+    return options
+
+
+def main(args=None):
+    summary = run(parse_args(args))
+    print(summary)
+    return 1 if summary.failed or summary.crashed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -309,10 +309,14 @@ class Message(object):
 
     def send(self):
         """Convenience method for sending via a specified backend.
+
+        Returns:
+            The result of the backend, such as the recipients refused via SMTP
+            or a Future when sending via a Dispatcher.
         """
         if not self.backend:
             raise Exception('No backend has been set for the message.')
-        self.backend.send(self)
+        return self.backend.send(self)
 
     def _convert_base64_to_printable(self, message, body, encoding):
         _charset = charset.Charset(encoding)